@@ -4,13 +4,19 @@ import google.generativeai as genai
 import os
 import logging
 import datetime
+import hashlib
+import json
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram import F
 import io
+import re
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,12 +25,39 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 DB_PATH = "chat_history.db"
+DB_READERS = 4
+HISTORY_LIMIT = 200
+HISTORY_CACHE_CHATS = 1000
+RESPONSE_CACHE_SIZE = 1024
+
+SAVE_BUTTON = "💾 Сохранить"
+CLEAR_BUTTON = "🗑️ Очистить"
+HELP_BUTTON = "❓ Помощь"
+BUTTONS = frozenset({SAVE_BUTTON, CLEAR_BUTTON, HELP_BUTTON})
 
 if not TELEGRAM_TOKEN or not GOOGLE_API_KEY:
     logging.error("Необходимые переменные окружения не найдены.")
     exit(1)
 
-bot = Bot(token=TELEGRAM_TOKEN)
+
+class KeepAliveSession(AiohttpSession):
+    """Сессия aiogram, которая дольше держит простаивающие соединения."""
+
+    def __init__(self, keepalive_timeout=75, **kwargs):
+        super().__init__(**kwargs)
+        # Публичного параметра для keep-alive нет, поэтому дополняем аргументы
+        # TCPConnector до того, как сессия будет создана. Атрибут приватный
+        # (есть в aiogram 3.0-3.31), так что при его исчезновении падаем сразу
+        connector_init = getattr(self, "_connector_init", None)
+        if not isinstance(connector_init, dict):
+            raise RuntimeError(
+                "AiohttpSession._connector_init не найден: эта версия aiogram "
+                "не поддерживает настройку keepalive_timeout")
+        connector_init["keepalive_timeout"] = keepalive_timeout
+
+
+# Одна HTTP-сессия на весь процесс; start_polling закрывает её при остановке
+bot = Bot(token=TELEGRAM_TOKEN, session=KeepAliveSession(limit=100))
 dp = Dispatcher(storage=MemoryStorage())
 genai.configure(api_key=GOOGLE_API_KEY)
 # Use a specific API version and the currently available model
@@ -32,57 +65,242 @@ model = genai.GenerativeModel(
     model_name='gemini-1.5-pro',
     generation_config={'temperature': 0.7})
 
-
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS chat_history (
-                chat_id INTEGER,
-                role TEXT,
-                content TEXT
-            )
-        """)
+# Блок кода, инлайн-код или одиночный символ Markdown, который нужно
+# экранировать вне кода
+ESCAPE_RE = re.compile(r"(```.*?```|`[^`\n]+`|[_\[`])", re.DOTALL)
+
+
+def _escape(match):
+    token = match.group(0)
+    if token.startswith("```\n"):
+        # Добавляем язык, если не указан
+        return "```python" + token[3:]
+    if len(token) > 1:
+        return token
+    return "\\" + token
+
+
+def escape_markdown(text):
+    # Обычный текст без спецсимволов возвращаем без прохода регуляркой
+    if "`" not in text and "_" not in text and "[" not in text:
+        return text
+    return ESCAPE_RE.sub(_escape, text)
+
+
+class SqlitePool:
+    """Одно соединение на запись и несколько read-only соединений на чтение."""
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self.readers = readers
+        self._rw = None
+        self._rw_lock = asyncio.Lock()
+        self._ro = asyncio.Queue(maxsize=readers)
+
+    async def open(self):
+        self._rw = await aiosqlite.connect(self.path)
+        await init_db(self._rw)
+        for _ in range(self.readers):
+            conn = await aiosqlite.connect(f"file:{self.path}?mode=ro",
+                                           uri=True,
+                                           check_same_thread=False)
+            # Эти PRAGMA действуют только на своё соединение
+            await conn.execute("PRAGMA temp_store=MEMORY")
+            await conn.execute("PRAGMA cache_size=-64000")
+            await self._ro.put(conn)
+
+    async def close(self):
+        while not self._ro.empty():
+            await self._ro.get_nowait().close()
+        if self._rw is not None:
+            await self._rw.close()
+            self._rw = None
+
+    @asynccontextmanager
+    async def acquire_rw(self):
+        async with self._rw_lock:
+            yield self._rw
+
+    @asynccontextmanager
+    async def acquire_ro(self):
+        conn = await self._ro.get()
+        try:
+            yield conn
+        finally:
+            self._ro.put_nowait(conn)
+
+
+POOL = SqlitePool(DB_PATH)
+# Последние сообщения по chat_id; вытесняется чат, к которому дольше всего
+# не обращались
+HISTORY_CACHE: OrderedDict[int, deque[dict]] = OrderedDict()
+
+
+class ChatState:
+    """Счётчики, по которым кэш истории согласуется с записями в БД."""
+
+    def __init__(self):
+        self.version = 0  # растёт перед каждой записью или очисткой
+        self.writers = 0  # записи, которые ещё не обновили кэш
+        self.clear_epoch = 0  # растёт при каждой очистке истории
+        self.users = 0  # корутины, которые сейчас держат это состояние
+
+
+# Состояние живёт, пока им кто-то пользуется, поэтому словарь не растёт
+# с числом когда-либо виденных чатов
+CHAT_STATES: dict[int, ChatState] = {}
+# Ответы модели по хэшу запроса (история + новое сообщение)
+RESPONSE_CACHE: OrderedDict[str, str] = OrderedDict()
+
+
+async def init_db(db):
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-64000")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS chat_history (
+            chat_id INTEGER,
+            role TEXT,
+            content TEXT,
+            type TEXT NOT NULL DEFAULT 'text'
+        )
+    """)
+    cursor = await db.execute("PRAGMA user_version")
+    (version, ) = await cursor.fetchone()
+    if version < 1:
         cursor = await db.execute("PRAGMA table_info(chat_history)")
         columns = [col[1] for col in await cursor.fetchall()]
         if 'type' not in columns:
             logging.info("Добавляем столбец 'type' в таблицу chat_history")
             await db.execute(
-                "ALTER TABLE chat_history ADD COLUMN type TEXT DEFAULT 'text'")
-        await db.commit()
-
-
-async def save_message(chat_id, role, content, msg_type="text"):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO chat_history (chat_id, role, content, type) VALUES (?, ?, ?, ?)",
-            (chat_id, role, content, msg_type))
-        await db.commit()
+                "ALTER TABLE chat_history ADD COLUMN type TEXT NOT NULL DEFAULT 'text'")
+        else:
+            await db.execute(
+                "UPDATE chat_history SET type = 'text' WHERE type IS NULL")
+        await db.execute("PRAGMA user_version = 1")
+    # Индекс по chat_id неявно упорядочен по rowid, поэтому
+    # ORDER BY rowid DESC LIMIT читается диапазоном индекса без сортировки
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat ON chat_history(chat_id)")
+    await db.commit()
+
+
+@contextmanager
+def chat_state(chat_id):
+    state = CHAT_STATES.get(chat_id)
+    if state is None:
+        state = CHAT_STATES[chat_id] = ChatState()
+    state.users += 1
+    try:
+        yield state
+    finally:
+        state.users -= 1
+        if state.users == 0:
+            del CHAT_STATES[chat_id]
+
+
+@contextmanager
+def history_write(state):
+    # Запись помечается до того, как её увидят читатели, и снимается только
+    # после обновления кэша, как в seqlock
+    state.version += 1
+    state.writers += 1
+    try:
+        yield
+    finally:
+        state.writers -= 1
+
+
+async def save_messages(chat_id, rows, clear_epoch=None):
+    """Сохраняет строки (chat_id, role, content, type) одной транзакцией.
+
+    Если передан clear_epoch и историю с тех пор очистили, строки отбрасываются.
+    """
+    if not rows:
+        return
+    with chat_state(chat_id) as state:
+        async with POOL.acquire_rw() as db:
+            # Проверка под тем же замком, что и DELETE в clear_chat_history
+            if clear_epoch is not None and state.clear_epoch != clear_epoch:
+                return
+            with history_write(state):
+                await db.executemany(
+                    "INSERT INTO chat_history (chat_id, role, content, type) VALUES (?, ?, ?, ?)",
+                    rows)
+                await db.commit()
+                cached = HISTORY_CACHE.get(chat_id)
+                if cached is not None:
+                    cached.extend({
+                        "role": role,
+                        "content": content,
+                        "type": msg_type
+                    } for _, role, content, msg_type in rows)
+
+
+async def load_chat_history(chat_id):
+    cached = HISTORY_CACHE.get(chat_id)
+    if cached is not None:
+        HISTORY_CACHE.move_to_end(chat_id)
+        return cached
+
+    with chat_state(chat_id) as state:
+        version = state.version
+        stable = state.writers == 0
+        async with POOL.acquire_ro() as db:
+            cursor = await db.execute(
+                "SELECT role, content, type FROM chat_history WHERE chat_id = ? ORDER BY rowid DESC LIMIT ?",
+                (chat_id, HISTORY_LIMIT))
+            rows = await cursor.fetchall()
+        stable = stable and state.writers == 0 and state.version == version
+
+    cached = deque(({"role": role, "content": content, "type": msg_type}
+                    for role, content, msg_type in reversed(rows)),
+                   maxlen=HISTORY_LIMIT)
+    if not stable:
+        # Снимок пересёкся с записью: отдаём его, но в кэш не кладём
+        return cached
+    HISTORY_CACHE[chat_id] = cached
+    if len(HISTORY_CACHE) > HISTORY_CACHE_CHATS:
+        HISTORY_CACHE.popitem(last=False)
+    return cached
 
 
 async def get_chat_history(chat_id, max_tokens=1000000):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT role, content, COALESCE(type, 'text') as type FROM chat_history WHERE chat_id = ? ORDER BY rowid DESC",
-            (chat_id, ))
-        rows = await cursor.fetchall()
+    entries = await load_chat_history(chat_id)
 
     history = []
     token_count = 0
-    for role, content, msg_type in rows:
-        text = f"{role}: {content} [{msg_type}]"
-        tokens = len(text.split())
+    for entry in reversed(entries):
+        # Грубая оценка по пробелам в "role: content [type]"
+        tokens = entry["content"].count(" ") + 3
         if token_count + tokens > max_tokens:
             break
         token_count += tokens
-        history.append({"role": role, "content": content, "type": msg_type})
+        history.append(entry)
     return list(reversed(history))
 
 
+async def export_chat_history(chat_id):
+    # Для выгрузки нужен весь диалог, поэтому читаем мимо кэша и без LIMIT
+    async with POOL.acquire_ro() as db:
+        cursor = await db.execute(
+            "SELECT role, content, type FROM chat_history WHERE chat_id = ? ORDER BY rowid",
+            (chat_id, ))
+        rows = await cursor.fetchall()
+    return [{"role": role, "content": content, "type": msg_type}
+            for role, content, msg_type in rows]
+
+
 async def clear_chat_history(chat_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM chat_history WHERE chat_id = ?",
-                         (chat_id, ))
-        await db.commit()
+    with chat_state(chat_id) as state:
+        async with POOL.acquire_rw() as db:
+            state.clear_epoch += 1
+            with history_write(state):
+                await db.execute(
+                    "DELETE FROM chat_history WHERE chat_id = ?", (chat_id, ))
+                await db.commit()
+                HISTORY_CACHE.pop(chat_id, None)
 
 
 @dp.message(Command("start"))
@@ -90,9 +308,9 @@ async def start_command(message: types.Message):
     username = message.from_user.first_name or message.from_user.username or "Пользователь"
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True,
                                    keyboard=[[
-                                       KeyboardButton(text="💾 Сохранить"),
-                                       KeyboardButton(text="🗑️ Очистить"),
-                                       KeyboardButton(text="❓ Помощь")
+                                       KeyboardButton(text=SAVE_BUTTON),
+                                       KeyboardButton(text=CLEAR_BUTTON),
+                                       KeyboardButton(text=HELP_BUTTON)
                                    ]])
     await message.answer(
         f"Привет, {username}! Я бот на базе Gemini 2.0 Pro Experimental.\n"
@@ -101,30 +319,25 @@ async def start_command(message: types.Message):
         reply_markup=keyboard)
 
 
-@dp.message(F.text == "💾 Сохранить")
 async def save_button_handler(message: types.Message):
     chat_id = message.chat.id
-    history = await get_chat_history(chat_id)
+    history = await export_chat_history(chat_id)
     if history:
         filename = f"chat_{chat_id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        with open(filename, "w", encoding="utf-8") as f:
-            for entry in history:
-                f.write(
-                    f"{entry['role']}: {entry['content']} [{entry['type']}]\n")
-        await message.answer_document(types.FSInputFile(filename),
-                                      caption="✅ История сохранена")
-        os.remove(filename)
+        data = "".join(
+            f"{entry['role']}: {entry['content']} [{entry['type']}]\n"
+            for entry in history).encode("utf-8")
+        document = types.BufferedInputFile(data, filename=filename)
+        await message.answer_document(document, caption="✅ История сохранена")
     else:
         await message.answer("⚠️ История пуста.")
 
 
-@dp.message(F.text == "🗑️ Очистить")
 async def clear_button_handler(message: types.Message):
     await clear_chat_history(message.chat.id)
     await message.answer("🗑️ История очищена.")
 
 
-@dp.message(F.text == "❓ Помощь")
 async def help_button_handler(message: types.Message):
     await message.answer("Команды:\n"
                          "💾 Сохранить - сохранить диалог\n"
@@ -133,151 +346,120 @@ async def help_button_handler(message: types.Message):
                          "Отправляйте текст, фото или аудио для анализа!")
 
 
+BUTTON_HANDLERS = {
+    SAVE_BUTTON: save_button_handler,
+    CLEAR_BUTTON: clear_button_handler,
+    HELP_BUTTON: help_button_handler,
+}
+
+
+@dp.message(F.text.in_(BUTTONS))
+async def handle_button(message: types.Message):
+    await BUTTON_HANDLERS[message.text](message)
+
+
+async def download_bytes(file):
+    # getvalue() у BytesIO без внешних ссылок отдаёт внутренний буфер без
+    # копирования, а сам BytesIO сразу освобождается
+    buffer = await bot.download(file, destination=io.BytesIO())
+    return buffer.getvalue()
+
+
+async def generate_response(content, cacheable=True):
+    if not cacheable:
+        response = await model.generate_content_async(content)
+        return response.text
+
+    key = hashlib.sha1(
+        json.dumps(content, ensure_ascii=False).encode("utf-8")).hexdigest()
+    cached = RESPONSE_CACHE.get(key)
+    if cached is not None:
+        RESPONSE_CACHE.move_to_end(key)
+        return cached
+
+    response = await model.generate_content_async(content)
+    RESPONSE_CACHE[key] = response.text
+    if len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        RESPONSE_CACHE.popitem(last=False)
+    return response.text
+
+
 async def process_content(message: types.Message, content_type: str):
     chat_id = message.chat.id
-    loading_message = await message.answer("⏳ Обрабатываю ваш запрос...")
-    await bot.send_chat_action(chat_id, "typing")
-
-    content = []
-    history = await get_chat_history(chat_id)
-    for entry in history:
-        if entry["type"] == "text":
+    # Состояние держим весь ход, чтобы номер очистки не сбросился
+    with chat_state(chat_id) as state:
+        loading_message = await message.answer("⏳ Обрабатываю ваш запрос...")
+        await bot.send_chat_action(chat_id, "typing")
+
+        content = []
+        pending = []
+        epoch = state.clear_epoch
+        history = await get_chat_history(chat_id)
+        for entry in history:
+            if entry["type"] == "text":
+                content.append({
+                    "role": "user" if entry["role"] == "user" else "model",
+                    "parts": [{
+                        "text": entry["content"]
+                    }]
+                })
+
+        if content_type == "text":
+            pending.append((chat_id, "user", message.text, "text"))
+            content.append({"role": "user", "parts": [{"text": message.text}]})
+        elif content_type == "photo":
+            photo_data = await download_bytes(message.photo[-1])
+            pending.append((chat_id, "user", "Фото", "image"))
             content.append({
-                "role": "user" if entry["role"] == "user" else "model",
+                "role":
+                "user",
                 "parts": [{
-                    "text": entry["content"]
+                    "file_data": {
+                        "mime_type": "image/jpeg",
+                        "data": photo_data
+                    }
+                }]
+            })
+        elif content_type == "audio":
+            audio_data = await download_bytes(message.audio)
+            pending.append((chat_id, "user", "Аудио", "audio"))
+            content.append({
+                "role":
+                "user",
+                "parts": [{
+                    "file_data": {
+                        "mime_type": "audio/mp3",
+                        "data": audio_data
+                    }
                 }]
             })
 
-    if content_type == "text":
-        await save_message(chat_id, "user", message.text)
-        content.append({"role": "user", "parts": [{"text": message.text}]})
-    elif content_type == "photo":
-        photo = await message.photo[-1].download(destination_file=io.BytesIO())
-        photo_data = photo.getvalue()
-        await save_message(chat_id, "user", "Фото", "image")
-        content.append({
-            "role":
-            "user",
-            "parts": [{
-                "file_data": {
-                    "mime_type": "image/jpeg",
-                    "data": photo_data
-                }
-            }]
-        })
-    elif content_type == "audio":
-        audio = await message.audio.download(destination_file=io.BytesIO())
-        audio_data = audio.getvalue()
-        await save_message(chat_id, "user", "Аудио", "audio")
-        content.append({
-            "role":
-            "user",
-            "parts": [{
-                "file_data": {
-                    "mime_type": "audio/mp3",
-                    "data": audio_data
-                }
-            }]
-        })
-
-    try:
-        response = await asyncio.to_thread(model.generate_content, content)
-        full_response = response.text
-        
-        # Обработка кода в ответе
-        # Находим код между ```python и ``` и выделяем его рамкой
-        formatted_response = full_response
-        
-        # Убедимся, что блоки кода правильно отформатированы
-        if "```" in formatted_response:
-            # Сохраняем оригинальный текст для базы данных
-            original_response = full_response
-            
-            # Обработка текста с учетом блоков кода
-            lines = formatted_response.split('\n')
-            in_code_block = False
-            for i, line in enumerate(lines):
-                if line.startswith("```"):
-                    in_code_block = not in_code_block
-                    # Добавляем язык, если не указан
-                    if line == "```" and not in_code_block:
-                        lines[i] = "```"
-                    elif line == "```" and in_code_block:
-                        lines[i] = "```python"
-                elif not in_code_block:
-                    # Находим и форматируем инлайн-код с символом ` 
-                    # но не экранируем сам инлайн-код
-                    new_line = ""
-                    j = 0
-                    while j < len(line):
-                        if j < len(line) - 1 and line[j] == '`' and line[j+1] != '`':
-                            # Начало инлайн-кода
-                            backtick_end = line.find('`', j + 1)
-                            if backtick_end != -1:
-                                # Сохраняем инлайн-код без изменений
-                                inline_code = line[j:backtick_end + 1]
-                                new_line += inline_code
-                                j = backtick_end + 1
-                            else:
-                                # Если нет закрывающей кавычки, добавляем как обычный текст
-                                new_line += line[j]
-                                j += 1
-                        else:
-                            # Обычный текст - экранируем Markdown символы кроме звездочек
-                            if line[j] == '_':
-                                new_line += "\\_"
-                            elif line[j] == '[':
-                                new_line += "\\["
-                            else:
-                                new_line += line[j]
-                            j += 1
-                    
-                    lines[i] = new_line
-            
-            formatted_response = '\n'.join(lines)
-        else:
-            # Более интеллектуальная обработка текста без кодовых блоков
-            # Находим и сохраняем инлайн-код с символом `
-            formatted_response = ""
-            i = 0
-            while i < len(full_response):
-                if i < len(full_response) - 1 and full_response[i] == '`' and full_response[i+1] != '`':
-                    # Начало инлайн-кода
-                    backtick_end = full_response.find('`', i + 1)
-                    if backtick_end != -1:
-                        # Сохраняем инлайн-код без изменений
-                        formatted_response += full_response[i:backtick_end + 1]
-                        i = backtick_end + 1
-                    else:
-                        # Если нет закрывающей кавычки, экранируем
-                        formatted_response += "\\`"
-                        i += 1
-                else:
-                    # Обычный текст - экранируем Markdown символы кроме звездочек
-                    if full_response[i] == '_':
-                        formatted_response += "\\_"
-                    elif full_response[i] == '[':
-                        formatted_response += "\\["
-                    else:
-                        formatted_response += full_response[i]
-                    i += 1
-            original_response = full_response
-        
-        await bot.edit_message_text(text=formatted_response,
-                                   chat_id=str(chat_id),
-                                   message_id=loading_message.message_id,
-                                   parse_mode="Markdown")
-        await save_message(chat_id, "bot", original_response)
-    except Exception as e:
-        logging.error(f"Ошибка при обработке: {e}")
-        await bot.edit_message_text(
-            text="⚠️ Произошла ошибка, попробуйте снова.",
-            chat_id=str(chat_id),
-            message_id=loading_message.message_id)
-
-
-@dp.message(F.text & ~(F.text.in_({"💾 Сохранить", "🗑️ Очистить", "❓ Помощь"})))
+        try:
+            # Запросы с фото или аудио не кэшируем
+            full_response = await generate_response(
+                content, cacheable=content_type == "text")
+
+            # Код оставляем как есть, а _ [ и непарные ` вне кода экранируем
+            formatted_response = escape_markdown(full_response)
+
+            await bot.edit_message_text(text=formatted_response,
+                                       chat_id=str(chat_id),
+                                       message_id=loading_message.message_id,
+                                       parse_mode="Markdown")
+            pending.append((chat_id, "bot", full_response, "text"))
+        except Exception as e:
+            logging.error(f"Ошибка при обработке: {e}")
+            await bot.edit_message_text(
+                text="⚠️ Произошла ошибка, попробуйте снова.",
+                chat_id=str(chat_id),
+                message_id=loading_message.message_id)
+        finally:
+            # Сообщение пользователя и ответ бота пишутся одним коммитом; если
+            # историю очистили во время генерации, этот ход в неё не попадает
+            await save_messages(chat_id, pending, clear_epoch=epoch)
+
+
+@dp.message(F.text & ~F.text.in_(BUTTONS))
 async def handle_text(message: types.Message):
     await process_content(message, "text")
 
@@ -293,7 +475,8 @@ async def handle_audio(message: types.Message):
 
 
 async def main():
-    await init_db()
+    await POOL.open()
+    dp.shutdown.register(POOL.close)
     await dp.start_polling(bot)
 
 